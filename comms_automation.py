@@ -1,6 +1,13 @@
 import streamlit as st
-import requests
+import hashlib
 import html
+import json
+import re
+import threading
+import time
+import zipfile
+from io import BytesIO
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # Common templates
 TEMPLATES = {
@@ -59,31 +66,129 @@ MODELS = {
     "Gemini 2.0 Flash": "google/gemini-2.0-flash-exp:free"
 }
 
-def call_openrouter(api_key, model, prompt):
-    """Call OpenRouter API with the specified model"""
-    try:
-        response = requests.post(
-            url="https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": model,
-                "messages": [
-                    {"role": "user", "content": prompt}
-                ]
-            },
-            timeout=60
-        )
+# AI responses are formatted as "INTRO:" followed by "IMPORTANT_NOTES:"
+AI_RESPONSE_RE = re.compile(r"INTRO:\s*(?P<intro>.*?)\s*IMPORTANT_NOTES:\s*(?P<notes>.*)", re.DOTALL)
+
+# Intro paragraph runs from "Hi!" to the first blank line followed by an emoji/symbol-led line;
+# when the greeting is followed directly by such a line there is no intro to consume
+INTRO_RE = re.compile(r"Hi!\n+(?:(?![^\w\s]).*?\n\n)?(?=[^\w\s])", re.DOTALL)
+INTRO_FALLBACK_RE = re.compile(r"Hi!\n+.*?(?=\n\n|$)", re.DOTALL)
+
+# Inline styles are kept on every element so hyperlinks survive pasting into Gmail
+HYPERLINK_HTML = '<a href="{url}" style="color: #0563C1; text-decoration: underline;">{text}</a>'
+BODY_HTML_OPEN = '<div style="font-family: Arial, sans-serif; line-height: 1.6; white-space: pre-wrap;">'
+BODY_HTML_CLOSE = '</div>'
+
+# Standalone files declare UTF-8 so emoji and "£" survive being opened locally
+HTML_DOCUMENT = '<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"><title>Communication</title></head>\n<body>{body}</body>\n</html>\n'
+
+@st.cache_resource
+def get_session():
+    """Shared HTTP session so repeat calls reuse the pooled keep-alive connection"""
+    # Imported here so UI-only cold starts don't pay for loading the HTTP stack
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    
+    session = requests.Session()
+    # Completions are billable and not idempotent: never resend after a read timeout, and keep
+    # status retries short so they fit inside the UI's 65 s budget
+    retries = Retry(
+        total=3,
+        read=0,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST"],
+        respect_retry_after_header=False
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retries))
+    return session
+
+def start_with_context(fn, *args):
+    """Run fn on its own thread, storing its return value or exception for the main thread to render"""
+    # A thread per call means concurrent sessions never queue behind each other. fn must not call
+    # st itself: the worker has no container stack, so its output would land outside the layout
+    result = {'value': None, 'error': None}
+    
+    def run():
+        try:
+            result['value'] = fn(*args)
+        except Exception as e:
+            result['error'] = e
+    
+    thread = threading.Thread(target=run, daemon=True)
+    add_script_run_ctx(thread, get_script_run_ctx())
+    thread.start()
+    return thread, result
+
+def hash_api_key(api_key):
+    """Fingerprint the API key so caches can key on it without storing the key itself"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+def fetch_completion(api_key, model, prompt, on_delta=None, cancel=None):
+    """Fetch a chat completion, raising on any failure"""
+    # Stream the reply over SSE, passing each new piece of text to on_delta
+    chunks = []
+    finished = False
+    with get_session().post(
+        url="https://openrouter.ai/api/v1/chat/completions",
+        headers={
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream"
+        },
+        json={
+            "model": model,
+            "messages": [
+                {"role": "user", "content": prompt}
+            ],
+            "stream": True
+        },
+        stream=True,
+        # Fail fast on connect, but give the model time between streamed chunks
+        timeout=(5, 60)
+    ) as response:
         response.raise_for_status()
-        return response.json()['choices'][0]['message']['content']
-    except Exception as e:
-        st.error(f"API Error: {str(e)}")
-        return None
-
-def generate_ai_content(api_key, model, template, ai_instructions):
-    """Generate AI-customized intro and important notes"""
+        for line in response.iter_lines():
+            # Stop once the UI has given up so an abandoned reply is never cached
+            if cancel is not None and cancel.is_set():
+                raise RuntimeError("The AI request was cancelled")
+            # Skip keep-alive comments such as ": OPENROUTER PROCESSING"
+            if not line.startswith(b"data: "):
+                continue
+            data = line[len(b"data: "):]
+            if data == b"[DONE]":
+                finished = True
+                break
+            event = json.loads(data)
+            if "error" in event:
+                raise RuntimeError(event["error"].get("message", "Streaming error"))
+            if event.get('choices'):
+                choice = event['choices'][0]
+                delta = choice.get('delta', {}).get('content') or ""
+                if delta:
+                    chunks.append(delta)
+                    if on_delta:
+                        on_delta(delta)
+                if choice.get('finish_reason'):
+                    finished = True
+    
+    # Raise rather than return so truncated or empty replies are never cached by callers
+    if not finished:
+        raise RuntimeError("The AI response stream ended before completing")
+    content = "".join(chunks)
+    if not content.strip():
+        raise RuntimeError("The AI returned an empty response")
+    return content
+
+def generate_ai_content(api_key, model, template, ai_instructions, on_delta=None, cancel=None):
+    """Generate AI-customized (response, intro, notes), raising on failure"""
+    return fetch_ai_content(hash_api_key(api_key), model, template, ai_instructions, api_key, on_delta, cancel)
+
+# Parsed results are cached, keyed on the API key's hash; fetch and parse failures raise and are never cached
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=64)
+def fetch_ai_content(api_key_hash, model, template, ai_instructions, _api_key, _on_delta=None, _cancel=None):
+    """Fetch and parse the AI-customized intro and important notes"""
     prompt = f"""You are helping customize a communication template for a market research task.
 
 Original template:
@@ -105,22 +210,116 @@ IMPORTANT_NOTES:
 
 Keep all X placeholders intact for mail merge. Match the tone and style of the original."""
 
-    return call_openrouter(api_key, model, prompt)
+    response = fetch_completion(_api_key, model, prompt, _on_delta, _cancel)
+    match = AI_RESPONSE_RE.search(response)
+    if not match:
+        raise ValueError("The AI response did not contain INTRO: and IMPORTANT_NOTES: sections")
+    return response, match['intro'].strip(), match['notes'].strip()
 
-def create_hyperlinked_html(template_text, links_dict):
-    """Create HTML with hyperlinked text"""
-    html_text = html.escape(template_text)
+def generate_ai_content_batch(api_key, model, jobs):
+    """Generate AI-customized intros for several queued jobs in one request"""
+    try:
+        return fetch_ai_content_batch(hash_api_key(api_key), model, jobs, api_key)
+    except Exception as e:
+        st.error(f"API Error: {str(e)}")
+        return None
+
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=64)
+def fetch_ai_content_batch(api_key_hash, model, jobs, _api_key):
+    """Fetch and parse one intro per queued job"""
+    blocks = "\n\n".join(
+        f"""### Job {number}
+Original template:
+{job['template']}
+
+Special instructions for this specific campaign:
+{job['instructions']}"""
+        for number, job in enumerate(jobs, start=1)
+    )
+    prompt = f"""You are helping customize communication templates for market research tasks.
+
+Produce {len(jobs)} customized intros, one for each job below.
+
+{blocks}
+
+For each job provide a customized intro paragraph (keep it friendly and brief, 2-3 sentences max) that reflects the special instructions provided.
+
+Return ONLY a JSON array with {len(jobs)} objects, in job order, each shaped as:
+{{"intro": "..."}}
+
+Keep all X placeholders intact for mail merge. Match the tone and style of each original."""
+
+    response = fetch_completion(_api_key, model, prompt)
     
-    # Replace each link category with a hyperlink
-    for category, url in links_dict.items():
+    # Models sometimes wrap the JSON in prose or a code fence, so parse only the array itself
+    try:
+        results = json.loads(response[response.find("["):response.rfind("]") + 1])
+    except ValueError:
+        results = None
+    if not isinstance(results, list) or len(results) != len(jobs) or not all(isinstance(r, dict) for r in results):
+        raise ValueError("Could not parse the batch AI response. Please try again.")
+    return results
+
+def replace_intro(template, intro):
+    """Replace the intro paragraph between the first "Hi!" and the first emoji line"""
+    template, count = INTRO_RE.subn(lambda match: f"Hi!\n\n{intro}\n\n", template, count=1)
+    if count == 0:
+        # No emoji-led line follows the greeting, so replace the paragraph right after it
+        template = INTRO_FALLBACK_RE.sub(lambda match: f"Hi!\n\n{intro}", template, count=1)
+    return template
+
+def compile_link_pattern(categories):
+    """Compile one regex matching any link category, longest first so overlapping texts link correctly"""
+    return re.compile("|".join(re.escape(category) for category in sorted(categories, key=len, reverse=True)))
+
+def split_links(links):
+    """Split links into parallel (categories, urls) tuples shared by every output"""
+    categories = tuple(link['category'] for link in links)
+    urls = tuple(link['url'] for link in links)
+    return categories, urls
+
+@st.cache_resource(max_entries=32)
+def compile_hyperlinks(categories, urls):
+    """Pre-render each link's anchor markup and compile the pattern that finds them"""
+    hyperlinks = {}
+    for category, url in zip(categories, urls):
         escaped_category = html.escape(category)
-        hyperlink = f'<a href="{html.escape(url)}" style="color: #0563C1; text-decoration: underline;">{escaped_category}</a>'
-        html_text = html_text.replace(escaped_category, hyperlink)
+        hyperlinks[escaped_category] = HYPERLINK_HTML.format(url=html.escape(url), text=escaped_category)
+    pattern = compile_link_pattern(hyperlinks) if hyperlinks else None
+    return hyperlinks, pattern
+
+def create_hyperlinked_html(template_text, compiled_links):
+    """Create HTML with hyperlinked text"""
+    html_text = html.escape(template_text)
     
-    # Convert newlines to <br> tags
-    html_text = html_text.replace('\n', '<br>')
+    # Emit plain and hyperlinked segments in order, converting newlines to <br> tags,
+    # and join them once so inserted markup is never rescanned or copied again
+    hyperlinks, pattern = compiled_links
+    parts = [BODY_HTML_OPEN]
+    prev = 0
+    if pattern:
+        for match in pattern.finditer(html_text):
+            parts.append(html_text[prev:match.start()].replace('\n', '<br>'))
+            parts.append(hyperlinks[match.group(0)])
+            prev = match.end()
+    parts.append(html_text[prev:].replace('\n', '<br>'))
+    parts.append(BODY_HTML_CLOSE)
     
-    return f'<div style="font-family: Arial, sans-serif; line-height: 1.6; white-space: pre-wrap;">{html_text}</div>'
+    return "".join(parts)
+
+def delete_selected_links():
+    """Remove every link queued for deletion in one pass, before the script reruns"""
+    selected = set(st.session_state.links_to_delete)
+    st.session_state.links = [link for idx, link in enumerate(st.session_state.links) if idx not in selected]
+    st.session_state.links_to_delete = []
+
+def clear_links():
+    """Remove all links before the script reruns"""
+    st.session_state.links = []
+
+def clear_jobs():
+    """Remove all queued batch jobs before the script reruns"""
+    st.session_state.jobs = []
 
 # Streamlit UI
 st.set_page_config(page_title="Comms Automation Tool", page_icon="✉️", layout="wide")
@@ -135,12 +334,14 @@ with st.sidebar:
     model_choice = st.selectbox("Select AI Model", options=list(MODELS.keys()))
     
     st.markdown("---")
-    st.markdown("**How to use:**")
-    st.markdown("1. Enter API key & select model")
-    st.markdown("2. Choose or customize template")
-    st.markdown("3. Add your links")
-    st.markdown("4. Provide AI instructions")
-    st.markdown("5. Generate & download!")
+    st.markdown(
+        "**How to use:**\n"
+        "1. Enter API key & select model\n"
+        "2. Choose or customize template\n"
+        "3. Add your links\n"
+        "4. Provide AI instructions\n"
+        "5. Generate & download!"
+    )
 
 # Main content
 col1, col2 = st.columns([1, 1])
@@ -172,32 +373,32 @@ with col1:
         st.session_state.links = []
     
     # Add new link
+    # The form only reruns the script on submit, not on every keystroke
     with st.expander("➕ Add New Link", expanded=True):
-        new_category = st.text_input("Link text (e.g., 'Instructions Brief')", key="new_category")
-        new_url = st.text_input("URL", key="new_url")
-        if st.button("Add Link"):
-            if new_category and new_url:
-                st.session_state.links.append({"category": new_category, "url": new_url})
-                st.success(f"Added: {new_category}")
-                st.rerun()
+        with st.form("add_link_form", clear_on_submit=True):
+            new_category = st.text_input("Link text (e.g., 'Instructions Brief')", key="new_category")
+            new_url = st.text_input("URL", key="new_url")
+            submitted = st.form_submit_button("Add Link")
+        if submitted and new_category and new_url:
+            st.session_state.links.append({"category": new_category, "url": new_url})
+            st.success(f"Added: {new_category}")
     
     # Display existing links
     if st.session_state.links:
         st.markdown("**Current Links:**")
-        for idx, link in enumerate(st.session_state.links):
-            col_a, col_b, col_c = st.columns([3, 5, 1])
-            with col_a:
-                st.text(link['category'])
-            with col_b:
-                st.text(link['url'][:50] + "..." if len(link['url']) > 50 else link['url'])
-            with col_c:
-                if st.button("🗑️", key=f"delete_{idx}"):
-                    st.session_state.links.pop(idx)
-                    st.rerun()
+        # One table and one delete control keep the widget count constant however many links there are
+        st.dataframe(st.session_state.links, use_container_width=True, hide_index=False)
+        # Deletions are queued in the form and applied together by the submit callback
+        with st.form("delete_links_form"):
+            st.multiselect(
+                "Delete links",
+                range(len(st.session_state.links)),
+                format_func=lambda i: f"{i}: {st.session_state.links[i]['category']}",
+                key="links_to_delete"
+            )
+            st.form_submit_button("🗑️ Delete Selected", on_click=delete_selected_links)
     
-    if st.button("🗑️ Clear All Links"):
-        st.session_state.links = []
-        st.rerun()
+    st.button("🗑️ Clear All Links", on_click=clear_links)
 
 with col2:
     st.header("🤖 AI Customization")
@@ -229,44 +430,58 @@ with col2:
             with st.spinner("Generating your communication..."):
                 final_template = template_text
                 
-                # AI customization if enabled
+                # Start the AI request on its own thread so the reply can be previewed as it streams
+                ai_thread = None
+                streamed = []
+                cancel = threading.Event()
                 if use_ai:
+                    ai_thread, ai_result = start_with_context(
+                        generate_ai_content,
+                        api_key, 
+                        MODELS[model_choice], 
+                        template_text, 
+                        ai_instructions,
+                        streamed.append,
+                        cancel
+                    )
+                
+                # Split links into parallel tuples shared by every output below
+                categories, urls = split_links(st.session_state.links)
+                compiled_links = compile_hyperlinks(categories, urls)
+                
+                # AI customization if enabled
+                if ai_thread:
                     with st.spinner("AI is customizing your content..."):
-                        ai_response = generate_ai_content(
-                            api_key, 
-                            MODELS[model_choice], 
-                            template_text, 
-                            ai_instructions
-                        )
+                        # Show the response as it streams in instead of waiting for the full reply
+                        preview = st.empty()
+                        deadline = time.monotonic() + 65
+                        while ai_thread.is_alive() and time.monotonic() < deadline:
+                            if streamed:
+                                preview.markdown("".join(streamed))
+                            time.sleep(0.2)
+                        preview.empty()
                         
-                        if ai_response:
+                        if ai_thread.is_alive():
+                            cancel.set()
+                            st.error("API Error: the AI request timed out")
+                            ai_content = None
+                        else:
+                            if ai_result['error'] is not None:
+                                st.error(f"API Error: {str(ai_result['error'])}")
+                            ai_content = ai_result['value']
+                        
+                        if ai_content:
+                            ai_response, intro, notes = ai_content
                             st.success("✅ AI customization complete!")
                             with st.expander("View AI-generated content"):
                                 st.markdown(ai_response)
                             
-                            # Parse AI response and update template
-                            # This is a simple implementation - you might want to make it more sophisticated
-                            if "INTRO:" in ai_response and "IMPORTANT_NOTES:" in ai_response:
-                                parts = ai_response.split("IMPORTANT_NOTES:")
-                                intro = parts[0].replace("INTRO:", "").strip()
-                                notes = parts[1].strip()
-                                
-                                # Replace intro paragraph (between first "Hi!" and first emoji line)
-                                if "Hi!" in final_template:
-                                    intro_start = final_template.find("Hi!")
-                                    intro_end = final_template.find("🍽️")
-                                    if intro_end > intro_start:
-                                        final_template = (final_template[:intro_start] + 
-                                                        f"Hi!\n\n{intro}\n\n" + 
-                                                        final_template[intro_end:])
+                            final_template = replace_intro(final_template, intro)
                         else:
                             st.warning("AI customization failed. Using original template.")
                 
-                # Create links dictionary
-                links_dict = {link['category']: link['url'] for link in st.session_state.links}
-                
                 # Generate HTML with hyperlinks
-                html_output = create_hyperlinked_html(final_template, links_dict)
+                html_output = create_hyperlinked_html(final_template, compiled_links)
                 
                 st.success("✅ Communication generated successfully!")
                 
@@ -281,13 +496,75 @@ with col2:
                 
                 # Also provide plain text version with markdown links as backup
                 with st.expander("📄 Alternative: Plain text with markdown links"):
-                    markdown_text = final_template
-                    for category, url in links_dict.items():
-                        markdown_text = markdown_text.replace(category, f"[{category}]({url})")
+                    urls_by_category = dict(zip(categories, urls))
+                    markdown_text = compile_link_pattern(categories).sub(
+                        lambda match: f"[{match.group(0)}]({urls_by_category[match.group(0)]})",
+                        final_template
+                    )
                     st.code(markdown_text, language=None)
                     st.caption("Copy this version if hyperlinks don't paste correctly")
                 
                 st.info("💡 All X fields are preserved for your Gmail mail merge!")
+    
+    st.markdown("---")
+    
+    st.header("📚 Batch Generation")
+    st.markdown("*Queue several template & instruction pairs and customize them all in a single AI request*")
+    
+    # Initialize session state for queued jobs
+    if 'jobs' not in st.session_state:
+        st.session_state.jobs = []
+    
+    if st.button("➕ Queue Current Template & Instructions"):
+        if not template_text or not ai_instructions:
+            st.error("Please provide both a template and AI instructions to queue!")
+        else:
+            st.session_state.jobs.append({"template": template_text, "instructions": ai_instructions})
+            st.success(f"Queued job {len(st.session_state.jobs)}")
+    
+    if st.session_state.jobs:
+        st.markdown(f"**Queued jobs:** {len(st.session_state.jobs)}")
+        st.button("🗑️ Clear Queue", on_click=clear_jobs)
+    
+    if st.button("Generate All Queued", use_container_width=True):
+        # Validation
+        if not st.session_state.jobs:
+            st.error("Please queue at least one job!")
+        elif not st.session_state.links:
+            st.error("Please add at least one link!")
+        elif not api_key:
+            st.error("Please enter your OpenRouter API key in the sidebar!")
+        else:
+            with st.spinner(f"AI is customizing {len(st.session_state.jobs)} communications..."):
+                results = generate_ai_content_batch(api_key, MODELS[model_choice], st.session_state.jobs)
+            
+            if results:
+                st.success(f"✅ Generated {len(results)} communications!")
+                categories, urls = split_links(st.session_state.links)
+                compiled_links = compile_hyperlinks(categories, urls)
+                
+                # Close the buffer as soon as its bytes are taken so only one copy of the ZIP stays alive
+                with BytesIO() as archive:
+                    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+                        for number, (job, result) in enumerate(zip(st.session_state.jobs, results), start=1):
+                            intro = result.get('intro')
+                            if isinstance(intro, str) and intro.strip():
+                                final_template = replace_intro(job['template'], intro.strip())
+                            else:
+                                st.warning(f"No intro returned for communication {number}. Using the template intro.")
+                                final_template = job['template']
+                            html_output = create_hyperlinked_html(final_template, compiled_links)
+                            zf.writestr(f"communication_{number}.html", HTML_DOCUMENT.format(body=html_output))
+                            with st.expander(f"📋 Communication {number}"):
+                                st.markdown(html_output, unsafe_allow_html=True)
+                    archive_bytes = archive.getvalue()
+                
+                st.download_button(
+                    "⬇️ Download All (ZIP)",
+                    data=archive_bytes,
+                    file_name="communications.zip",
+                    mime="application/zip"
+                )
 
 # Footer
 st.markdown("---")